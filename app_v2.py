@@ -10,7 +10,14 @@ import pandas as pd
 import numpy as np
 from google.cloud import bigquery
 from sklearn.metrics.pairwise import cosine_similarity
+import atexit
 import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import uuid
 
 # --- BigQuery/Embedding/類似度計算のための関数群 ---
 
@@ -20,31 +27,39 @@ BQ_PUBLIC_PROJECT = "patents-public-data"
 BQ_DATASET = "patents"
 BQ_TABLE = "publications"
 BQ_LOCATION = "US"
-BQ_LIMIT = 100
+BQ_LIMIT = int(os.getenv("BQ_LIMIT", "100"))  # ランドスケープ調査では数千件に引き上げる
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_BATCH_SIZE = 100  # 1リクエストでまとめてベクトル化する件数
 
 # BigQueryから特許データを抽出
 def search_patents_by_params(params: dict) -> pd.DataFrame:
     # 公開データセット参照用にBQ_PUBLIC_PROJECT, BQ_LOCATIONを利用
     client = bigquery.Client(project=BQ_PROJECT, credentials=GCP_CREDENTIALS, location=BQ_LOCATION)
+    # 値はすべてクエリパラメータで渡す（出願人名などを SQL に埋め込まない）
     where = []
+    query_params = []
     if params.get("ipc_codes"):
-        ipc_list = [f"'{c}'" for c in params["ipc_codes"]]
-        where.append(f"ipc.code IN ({','.join(ipc_list)})")
+        where.append("ipc.code IN UNNEST(@ipc_codes)")
+        query_params.append(bigquery.ArrayQueryParameter("ipc_codes", "STRING", list(params["ipc_codes"])))
     if params.get("countries"):
-        if isinstance(params["countries"], list):
-            countries = [f"'{c}'" for c in params["countries"]]
-        else:
-            countries = [f"'{params['countries']}'"]
-        where.append(f"country_code IN ({','.join(countries)})")
+        countries = params["countries"] if isinstance(params["countries"], list) else [params["countries"]]
+        where.append("country_code IN UNNEST(@countries)")
+        query_params.append(bigquery.ArrayQueryParameter("countries", "STRING", countries))
     if params.get("assignees"):
-        if isinstance(params["assignees"], list):
-            assignees = [f"'{a}'" for a in params["assignees"]]
-        else:
-            assignees = [f"'{params['assignees']}'"]
-        where.append(f"assignee IN ({','.join(assignees)})")
+        assignees = params["assignees"] if isinstance(params["assignees"], list) else [params["assignees"]]
+        # assignee_harmonized.name は正式名称（例: "SONY CORP"）のため、入力名との大文字の前方一致で比較する
+        where.append(
+            "EXISTS(SELECT 1 FROM UNNEST(p.assignee_harmonized) AS a, UNNEST(@assignees) AS q"
+            " WHERE STARTS_WITH(UPPER(a.name), q))"
+        )
+        query_params.append(
+            bigquery.ArrayQueryParameter("assignees", "STRING", [a.strip().upper() for a in assignees if a.strip()])
+        )
     if params.get("publication_from"):
-        where.append(f"publication_date >= '{params['publication_from']}'")
+        # publication_date は INT64 の YYYYMMDD 形式
+        publication_from = int(pd.to_datetime(params["publication_from"]).strftime("%Y%m%d"))
+        where.append("publication_date >= @publication_from")
+        query_params.append(bigquery.ScalarQueryParameter("publication_from", "INT64", publication_from))
     where_clause = " AND ".join(where) if where else "1=1"
     sql = f"""
         SELECT
@@ -61,7 +76,8 @@ def search_patents_by_params(params: dict) -> pd.DataFrame:
         GROUP BY publication_number, title, abstract, publication_date
         LIMIT {BQ_LIMIT}
     """
-    df = client.query(sql).to_dataframe()
+    job_config = bigquery.QueryJobConfig(query_parameters=query_params)
+    df = client.query(sql, job_config=job_config).to_dataframe()
     return df
 
 # 特許テキストをベクトル化（OpenAI API例）
@@ -69,19 +85,515 @@ def vectorize_texts(texts: list, openai_api_key: str) -> np.ndarray:
     import openai
     client = openai.OpenAI(api_key=openai_api_key)
     vectors = []
-    for text in texts:
-        resp = client.embeddings.create(input=text, model=EMBEDDING_MODEL)
-        vectors.append(resp.data[0].embedding)
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        resp = client.embeddings.create(input=texts[start:start + EMBEDDING_BATCH_SIZE], model=EMBEDDING_MODEL)
+        vectors.extend(d.embedding for d in sorted(resp.data, key=lambda d: d.index))
     return np.array(vectors)
 
+# 埋め込みストアに未登録の特許だけベクトル化し、全件の行番号を返す
+# テキストが空の特許は API がバッチごと拒否するためベクトル化せず、行番号 -1 のまま返す
+def embed_with_store(patent_texts: list, patent_ids: list, openai_api_key: str) -> np.ndarray:
+    emb_store = get_embedding_store()
+    rows = emb_store.lookup(patent_ids)
+    missing = [i for i in np.flatnonzero(rows < 0) if patent_texts[i].strip()]
+    # バッチごとにストアへ書き込み、未登録分のベクトルをまとめてメモリに保持しない
+    for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+        batch = missing[start:start + EMBEDDING_BATCH_SIZE]
+        new_vecs = vectorize_texts([patent_texts[i] for i in batch], openai_api_key)
+        rows[batch] = emb_store.add([patent_ids[i] for i in batch], new_vecs)
+    return rows
+
 # クエリと特許ベクトルの類似度ランキング
-def rank_by_similarity(query: str, patent_texts: list, openai_api_key: str) -> list:
+# patent_ids を渡すと量子化ストア経由で2段階スコアリングし、埋め込みも再利用する
+def rank_by_similarity(query: str, patent_texts: list, openai_api_key: str, patent_ids: list = None) -> list:
     query_vec = vectorize_texts([query], openai_api_key)[0].reshape(1, -1)
-    patent_vecs = vectorize_texts(patent_texts, openai_api_key)
-    sims = cosine_similarity(query_vec, patent_vecs)[0]
-    ranked_idx = np.argsort(sims)[::-1]
+    if patent_ids is None:
+        patent_vecs = vectorize_texts(patent_texts, openai_api_key)
+        sims = cosine_similarity(query_vec, patent_vecs)[0]
+        ranked_idx = np.argsort(sims)[::-1]
+        return ranked_idx, sims
+
+    emb_store = get_embedding_store()
+    rows = embed_with_store(patent_texts, patent_ids, openai_api_key)
+    # テキストが空でベクトルのない特許は末尾に回す
+    embedded = np.flatnonzero(rows >= 0)
+
+    sims = np.full(len(rows), np.nan, dtype=np.float32)
+    if len(embedded) <= EXACT_SCAN_MAX_ROWS:
+        # 件数が少なければ2段階にする利点はないため、全件を厳密にスコアリングする
+        sims[embedded] = emb_store.exact_scores(rows[embedded], query_vec[0])
+        ranked_idx = np.concatenate([embedded[np.argsort(sims[embedded])[::-1]], np.flatnonzero(rows < 0)])
+        return ranked_idx, sims
+
+    # 1段目: 圧縮コードで全件を近似スコアリング（並べ替えにのみ使う）
+    approx = emb_store.approx_scores(rows[embedded], query_vec[0])
+    ranked_idx = embedded[np.argsort(approx)[::-1]]
+    # 2段目: 上位候補のみ全精度ベクトルで厳密に再スコアリング
+    # 再スコアリングしていない行の類似度は近似値と混ざらないよう NaN（空欄）にする
+    top = ranked_idx[:RERANK_CANDIDATES]
+    sims[top] = emb_store.exact_scores(rows[top], query_vec[0])
+    ranked_idx = np.concatenate([
+        top[np.argsort(sims[top])[::-1]], ranked_idx[RERANK_CANDIDATES:], np.flatnonzero(rows < 0)
+    ])
     return ranked_idx, sims
 
+# --- セッションデータストア（検索結果・ランキングのコンパクト保持） ---
+
+# メモリ予算（MB）と退避先ディレクトリ
+SESSION_MEMORY_BUDGET_MB = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "256"))
+GLOBAL_MEMORY_BUDGET_MB = int(os.getenv("GLOBAL_MEMORY_BUDGET_MB", "2048"))
+# 未指定ならプロセス専用の一時ディレクトリ（0700）を作成する
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR")
+# この秒数アクセスのないセッションの結果は破棄する
+SESSION_IDLE_TTL_SEC = int(os.getenv("SESSION_IDLE_TTL_SEC", "7200"))
+SESSION_SWEEP_INTERVAL_SEC = 60
+# ユニーク率がこの値以下の文字列列はカテゴリ型にする
+CATEGORY_RATIO = 0.5
+
+# 検索結果DataFrameをArrow文字列・カテゴリ型に変換してメモリを削減
+def compact_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        n_unique = df[col].nunique(dropna=True)
+        if len(df) and n_unique / len(df) <= CATEGORY_RATIO:
+            df[col] = df[col].astype("category")
+        else:
+            df[col] = df[col].astype("string[pyarrow]")
+    return df
+
+# ランキング結果は DataFrame のコピーではなく index+score 配列で保持する
+def compact_ranking(ranked_idx, sims) -> dict:
+    return {
+        "idx": np.asarray(ranked_idx, dtype=np.int32),
+        "scores": np.asarray(sims, dtype=np.float32),
+        "token": uuid.uuid4().hex,  # エクスポート等のメモ化キー
+    }
+
+# 保持している index+score から表示用のランキングDataFrameを組み立てる
+def build_ranked_df(df: pd.DataFrame, ranking: dict) -> pd.DataFrame:
+    idx = ranking["idx"]
+    return df.iloc[idx].assign(similarity=ranking["scores"][idx])
+
+def _estimate_nbytes(value) -> int:
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, np.ndarray):
+        return int(value.nbytes)
+    if isinstance(value, dict):
+        return sum(_estimate_nbytes(v) for v in value.values())
+    return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+
+# 退避ファイルは pickle で読み戻すため、他ユーザーが書き込めるディレクトリは使わない
+def _check_private_dir(path: str):
+    st_dir = os.stat(path)
+    if hasattr(os, "getuid") and (st_dir.st_uid != os.getuid() or st_dir.st_mode & 0o077):
+        raise PermissionError(f"{path} は他のユーザーからアクセス可能です。所有者のみ (0700) に設定してください。")
+
+class SessionStore:
+    """
+    全セッション共有の結果ストア。
+    セッションごと・全体のメモリ予算を超えると、最も長く参照されていない項目を
+    ディスクへ退避し、次に参照されたときに遅延ロードする。
+    """
+
+    def __init__(self, session_budget: int, global_budget: int, spill_dir: str = None, idle_ttl: int = SESSION_IDLE_TTL_SEC):
+        self.session_budget = session_budget
+        self.global_budget = global_budget
+        self.idle_ttl = idle_ttl
+        if spill_dir is None:
+            spill_dir = tempfile.mkdtemp(prefix="patentsfinder_sessions_")
+            atexit.register(shutil.rmtree, spill_dir, ignore_errors=True)
+        else:
+            os.makedirs(spill_dir, mode=0o700, exist_ok=True)
+            _check_private_dir(spill_dir)
+            # 前回プロセスの退避ファイルは索引が失われているため削除する
+            for name in os.listdir(spill_dir):
+                if name.endswith(".pkl"):
+                    os.remove(os.path.join(spill_dir, name))
+        self.spill_dir = spill_dir
+        # (session_id, key) -> {"value", "nbytes", "last_access", "path"}
+        self._items = {}
+        # session_id -> 最終アクセス時刻
+        self._session_access = {}
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _touch(self, session_id: str):
+        self._sweep_idle_sessions()
+        self._session_access[session_id] = time.monotonic()
+
+    # 一定時間アクセスのないセッションの項目（退避ファイルを含む）を破棄する
+    def _sweep_idle_sessions(self):
+        now = time.monotonic()
+        if now - self._last_sweep < SESSION_SWEEP_INTERVAL_SEC:
+            return
+        self._last_sweep = now
+        for sid, last_access in list(self._session_access.items()):
+            if now - last_access <= self.idle_ttl:
+                continue
+            for k in [k for k in self._items if k[0] == sid]:
+                self._remove(*k)
+            del self._session_access[sid]
+
+    def put(self, session_id: str, key: str, value):
+        with self._lock:
+            self._touch(session_id)
+            self._remove(session_id, key)
+            self._items[(session_id, key)] = {
+                "value": value,
+                "nbytes": _estimate_nbytes(value),
+                "last_access": time.monotonic(),
+                "path": None,
+            }
+            self._enforce_budgets(session_id, keep=(session_id, key))
+
+    def get(self, session_id: str, key: str, default=None):
+        with self._lock:
+            self._touch(session_id)
+            item = self._items.get((session_id, key))
+            if item is None:
+                return default
+            item["last_access"] = time.monotonic()
+            if item["value"] is None:
+                # ディスクから遅延ロード
+                with open(item["path"], "rb") as f:
+                    item["value"] = pickle.load(f)
+                os.remove(item["path"])
+                item["path"] = None
+                self._enforce_budgets(session_id, keep=(session_id, key))
+            return item["value"]
+
+    def delete(self, session_id: str, key: str):
+        with self._lock:
+            self._remove(session_id, key)
+
+    def _remove(self, session_id: str, key: str):
+        item = self._items.pop((session_id, key), None)
+        if item is not None and item["path"] and os.path.exists(item["path"]):
+            os.remove(item["path"])
+
+    def _resident(self, session_id=None) -> list:
+        return [
+            (k, item) for k, item in self._items.items()
+            if item["value"] is not None and (session_id is None or k[0] == session_id)
+        ]
+
+    def _enforce_budgets(self, session_id: str, keep: tuple):
+        for scope, budget in ((session_id, self.session_budget), (None, self.global_budget)):
+            resident = sorted(self._resident(scope), key=lambda kv: kv[1]["last_access"])
+            total = sum(item["nbytes"] for _, item in resident)
+            for k, item in resident:
+                if total <= budget:
+                    break
+                if k == keep:
+                    continue
+                self._spill(k, item)
+                total -= item["nbytes"]
+
+    def _spill(self, k: tuple, item: dict):
+        path = os.path.join(self.spill_dir, f"{k[0]}_{k[1]}.pkl")
+        with open(path, "wb") as f:
+            pickle.dump(item["value"], f, protocol=pickle.HIGHEST_PROTOCOL)
+        item["value"] = None
+        item["path"] = path
+
+@st.cache_resource
+def get_session_store() -> SessionStore:
+    return SessionStore(
+        SESSION_MEMORY_BUDGET_MB * 1024 * 1024,
+        GLOBAL_MEMORY_BUDGET_MB * 1024 * 1024,
+        SESSION_SPILL_DIR,
+    )
+
+# --- 埋め込みベクトルの量子化ストア（int8 / 直積量子化 + 全精度再スコアリング） ---
+
+# 共有の一時ディレクトリではなくユーザーのキャッシュに置く（所有者のみアクセス可能であること）
+EMBEDDING_STORE_DIR = os.getenv(
+    "EMBEDDING_STORE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "patentsfinder_embeddings")
+)
+# 直積量子化のサブ空間数（0 なら int8 スカラー量子化のみ）
+EMBEDDING_PQ_SUBSPACES = int(os.getenv("EMBEDDING_PQ_SUBSPACES", "0"))
+# 直積量子化のコードブックを学習する最小件数
+PQ_TRAIN_MIN = 2048
+PQ_CENTROIDS = 256
+# 1段目の近似スコアリングで一度に展開する行数（CPU キャッシュに収まる大きさ）
+APPROX_CHUNK_ROWS = 1024
+# この件数以下なら2段階にせず全件を全精度ベクトルでスコアリングする
+EXACT_SCAN_MAX_ROWS = int(os.getenv("EXACT_SCAN_MAX_ROWS", "5000"))
+# 全精度ベクトルで再スコアリングする上位候補数
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "50"))
+
+class EmbeddingStore:
+    """
+    特許の埋め込みベクトルをディスク上にメモリマップで保持するストア。
+    正規化済み float32 の全精度ベクトルに加え、int8 スカラー量子化コード
+    （ベクトルごとのスケール付き）と、任意で直積量子化コードを持つ。
+    1段目は圧縮コードのみを走査し、全精度ベクトルは再スコアリング対象の行だけ読み込む。
+    """
+
+    def __init__(self, root_dir: str, pq_subspaces: int = 0):
+        self.root_dir = root_dir
+        self.pq_subspaces = pq_subspaces
+        # 他ユーザーが仕込んだベクトルやコードブックを読み込まないよう、所有者専用に限る
+        os.makedirs(root_dir, mode=0o700, exist_ok=True)
+        _check_private_dir(root_dir)
+        self._lock = threading.Lock()
+        self._meta_path = os.path.join(root_dir, "meta.json")
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+        else:
+            meta = {"dim": None}
+        self.dim = meta["dim"]
+        # id は追記専用の ids.txt に1行1件で保持する（最終行が改行で終わらなければ書きかけ）
+        self._ids_path = self._path("ids.txt")
+        self.ids = []
+        if os.path.exists(self._ids_path):
+            with open(self._ids_path, "rb") as f:
+                self.ids = f.read().decode("utf-8").split("\n")[:-1]
+        self._rows = {pid: i for i, pid in enumerate(self.ids)}
+        self.codebooks = None
+        codebook_path = self._path("pq_codebooks.npy")
+        if os.path.exists(codebook_path):
+            self.codebooks = np.load(codebook_path)
+        self._training = False
+        self._repair_files()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root_dir, name)
+
+    def _memmap(self, name: str, dtype, width: int, n_rows: int = None):
+        n_rows = len(self.ids) if n_rows is None else n_rows
+        shape = (n_rows, width) if width else (n_rows,)
+        return np.memmap(self._path(name), dtype=dtype, mode="r", shape=shape)
+
+    # データファイル名 -> 1行あたりのバイト数
+    def _row_bytes(self) -> dict:
+        row_bytes = {"vectors.f32": 4 * self.dim, "codes.i8": self.dim, "scales.f32": 4}
+        if self.codebooks is not None:
+            row_bytes["pq_codes.u8"] = self.codebooks.shape[0]
+        return row_bytes
+
+    def _truncate_files(self, n_rows: int):
+        for name, nbytes in self._row_bytes().items():
+            path = self._path(name)
+            if os.path.exists(path) and os.path.getsize(path) > n_rows * nbytes:
+                os.truncate(path, n_rows * nbytes)
+
+    def _drop_pq(self):
+        self.codebooks = None
+        for name in ("pq_codebooks.npy", "pq_codes.u8"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+
+    def _repair_files(self):
+        """
+        ids.txt は各データファイルへの追記後に追記するため、途中で異常終了すると
+        データファイルだけが長くなる。ids.txt と各データファイルのうち最も短い件数に
+        そろえて切り詰め、以降の追記位置と id の対応を保つ。
+        """
+        if self.dim is None:
+            return
+        pq_path = self._path("pq_codes.u8")
+        if self.codebooks is None or not os.path.exists(pq_path) or (
+            os.path.getsize(pq_path) < len(self.ids) * self.codebooks.shape[0]
+        ):
+            # 学習途中で終了した直積量子化は破棄し、次回の追加時に学習し直す
+            self._drop_pq()
+        n_rows = len(self.ids)
+        for name, nbytes in self._row_bytes().items():
+            path = self._path(name)
+            n_rows = min(n_rows, os.path.getsize(path) // nbytes if os.path.exists(path) else 0)
+        if n_rows < len(self.ids):
+            del self.ids[n_rows:]
+            self._rows = {pid: i for i, pid in enumerate(self.ids)}
+        # 書きかけの最終行や余分な行を取り除く
+        ids_bytes = "".join(f"{pid}\n" for pid in self.ids).encode("utf-8")
+        if not os.path.exists(self._ids_path) or os.path.getsize(self._ids_path) != len(ids_bytes):
+            with open(self._ids_path, "wb") as f:
+                f.write(ids_bytes)
+        self._truncate_files(n_rows)
+
+    def _save_meta(self):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim}, f)
+        os.replace(tmp_path, self._meta_path)
+
+    # 公開番号から行番号を引く（未登録は -1）
+    def lookup(self, patent_ids: list) -> np.ndarray:
+        return np.array([self._rows.get(pid, -1) for pid in patent_ids], dtype=np.int64)
+
+    def add(self, patent_ids: list, vectors: np.ndarray) -> np.ndarray:
+        vecs = np.asarray(vectors, dtype=np.float32)
+        vecs /= np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+        # int8 スカラー量子化（ベクトルごとに最大絶対値を 127 に合わせる）
+        scales = np.maximum(np.abs(vecs).max(axis=1), 1e-12) / 127.0
+        codes = np.round(vecs / scales[:, None]).astype(np.int8)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vecs.shape[1]
+                self._save_meta()
+            start = len(self.ids)
+            ids_size = os.path.getsize(self._ids_path) if os.path.exists(self._ids_path) else 0
+            try:
+                with open(self._path("vectors.f32"), "ab") as f:
+                    f.write(vecs.tobytes())
+                with open(self._path("codes.i8"), "ab") as f:
+                    f.write(codes.tobytes())
+                with open(self._path("scales.f32"), "ab") as f:
+                    f.write(scales.astype(np.float32).tobytes())
+                if self.codebooks is not None:
+                    with open(self._path("pq_codes.u8"), "ab") as f:
+                        f.write(self._pq_encode(vecs, self.codebooks).tobytes())
+                # id の追記をもって確定とする（既存 id 全体は書き直さない）
+                with open(self._ids_path, "ab") as f:
+                    f.write("".join(f"{pid}\n" for pid in patent_ids).encode("utf-8"))
+            except Exception:
+                # 書きかけの行を取り除いて id との対応を保つ
+                self._truncate_files(start)
+                if os.path.exists(self._ids_path):
+                    os.truncate(self._ids_path, ids_size)
+                raise
+            for i, pid in enumerate(patent_ids):
+                self._rows[pid] = start + i
+            self.ids.extend(patent_ids)
+            if self.pq_subspaces and self.codebooks is None and not self._training and len(self.ids) >= PQ_TRAIN_MIN:
+                # 学習はリクエスト処理とロックの外（バックグラウンド）で行う
+                self._training = True
+                threading.Thread(target=self._train_pq, args=(len(self.ids),), daemon=True).start()
+        return np.arange(start, start + len(patent_ids))
+
+    def _train_pq(self, n_train: int):
+        from sklearn.cluster import MiniBatchKMeans
+        try:
+            vecs = self._memmap("vectors.f32", np.float32, self.dim, n_rows=n_train)
+            sub_dim = self.dim // self.pq_subspaces
+            sample = np.asarray(vecs[:: max(1, n_train // (PQ_CENTROIDS * 40))])
+            codebooks = []
+            for m in range(self.pq_subspaces):
+                km = MiniBatchKMeans(n_clusters=PQ_CENTROIDS, batch_size=4096, n_init=3, random_state=0)
+                km.fit(sample[:, m * sub_dim:(m + 1) * sub_dim])
+                codebooks.append(km.cluster_centers_.astype(np.float32))
+            codebooks = np.stack(codebooks)  # (M, 256, sub_dim)
+            # 学習時点までのベクトルを一時ファイルに符号化
+            tmp_path = self._path("pq_codes.u8.tmp")
+            with open(tmp_path, "wb") as f:
+                for start in range(0, n_train, 8192):
+                    f.write(self._pq_encode(np.asarray(vecs[start:start + 8192]), codebooks).tobytes())
+            with self._lock:
+                # 学習中に追加された行を符号化してから差し替え、直積量子化を有効にする
+                n_rows = len(self.ids)
+                if n_rows > n_train:
+                    new_vecs = self._memmap("vectors.f32", np.float32, self.dim, n_rows=n_rows)[n_train:]
+                    with open(tmp_path, "ab") as f:
+                        f.write(self._pq_encode(np.asarray(new_vecs), codebooks).tobytes())
+                os.replace(tmp_path, self._path("pq_codes.u8"))
+                np.save(self._path("pq_codebooks.npy"), codebooks)
+                self.codebooks = codebooks
+        finally:
+            self._training = False
+
+    @staticmethod
+    def _pq_encode(vecs: np.ndarray, codebooks: np.ndarray) -> np.ndarray:
+        n_sub, _, sub_dim = codebooks.shape
+        codes = np.empty((len(vecs), n_sub), dtype=np.uint8)
+        for m in range(n_sub):
+            sub = vecs[:, m * sub_dim:(m + 1) * sub_dim]
+            # ||x - c||^2 の最小化は ||c||^2 - 2 x·c の最小化と同じ
+            dists = (codebooks[m] ** 2).sum(axis=1) - 2.0 * sub @ codebooks[m].T
+            codes[:, m] = dists.argmin(axis=1)
+        return codes
+
+    # 圧縮コードによる近似コサイン類似度
+    def approx_scores(self, rows: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
+        q = np.asarray(query_vec, dtype=np.float32)
+        q = q / max(np.linalg.norm(q), 1e-12)
+        codebooks = self.codebooks
+        scores = np.empty(len(rows), dtype=np.float32)
+        # 一時配列が APPROX_CHUNK_ROWS 行分を超えないよう、チャンク単位で走査する
+        if codebooks is not None:
+            # 直積量子化: サブ空間ごとの内積テーブルを引いて合計する
+            n_sub, _, sub_dim = codebooks.shape
+            table = np.einsum("mkd,md->mk", codebooks, q[: n_sub * sub_dim].reshape(n_sub, sub_dim))
+            pq_codes = self._memmap("pq_codes.u8", np.uint8, n_sub)
+            for start in range(0, len(rows), APPROX_CHUNK_ROWS):
+                chunk = pq_codes[rows[start:start + APPROX_CHUNK_ROWS]]
+                scores[start:start + len(chunk)] = table[np.arange(n_sub), chunk].sum(axis=1)
+            return scores
+        codes = self._memmap("codes.i8", np.int8, self.dim)
+        scales = self._memmap("scales.f32", np.float32, 0)
+        for start in range(0, len(rows), APPROX_CHUNK_ROWS):
+            chunk_rows = rows[start:start + APPROX_CHUNK_ROWS]
+            scores[start:start + len(chunk_rows)] = (codes[chunk_rows].astype(np.float32) @ q) * scales[chunk_rows]
+        return scores
+
+    # 全精度ベクトルによる厳密なコサイン類似度（指定行のみ読み込む）
+    def exact_scores(self, rows: np.ndarray, query_vec: np.ndarray) -> np.ndarray:
+        q = np.asarray(query_vec, dtype=np.float32)
+        q = q / max(np.linalg.norm(q), 1e-12)
+        return self.vectors(rows) @ q
+
+    # 指定行の全精度ベクトルを読み込む
+    def vectors(self, rows: np.ndarray) -> np.ndarray:
+        return self._memmap("vectors.f32", np.float32, self.dim)[rows]
+
+@st.cache_resource
+def get_embedding_store() -> EmbeddingStore:
+    # モデルが変わると次元が変わるため、モデルごとに保存先を分ける
+    os.makedirs(EMBEDDING_STORE_DIR, mode=0o700, exist_ok=True)
+    _check_private_dir(EMBEDDING_STORE_DIR)
+    return EmbeddingStore(os.path.join(EMBEDDING_STORE_DIR, EMBEDDING_MODEL), EMBEDDING_PQ_SUBSPACES)
+
+# --- トピッククラスタリング（ランドスケープ調査用） ---
+
+CLUSTER_BATCH_SIZE = 4096  # 一度にメモリへ読み込むベクトル数
+CLUSTER_EPOCHS = 3
+CLUSTER_KEYWORDS = 6
+CLUSTER_MAX_VOCAB = 20000
+
+# 埋め込みストア上の行をミニバッチ k-means でクラスタリングする
+# ベクトルはチャンク単位で memmap から読むため、件数によらずメモリ使用量は一定
+def cluster_embeddings(rows: np.ndarray, n_clusters: int) -> np.ndarray:
+    from sklearn.cluster import MiniBatchKMeans
+    emb_store = get_embedding_store()
+    km = MiniBatchKMeans(n_clusters=n_clusters, batch_size=CLUSTER_BATCH_SIZE, n_init=3, random_state=0)
+    rng = np.random.default_rng(0)
+    for _ in range(CLUSTER_EPOCHS):
+        order = rng.permutation(len(rows))
+        for start in range(0, len(rows), CLUSTER_BATCH_SIZE):
+            # チャンク内は行番号順に読んで memmap のアクセスを連続させる
+            chunk = np.sort(rows[order[start:start + CLUSTER_BATCH_SIZE]])
+            if start and len(chunk) < n_clusters:
+                continue
+            km.partial_fit(emb_store.vectors(chunk))
+    labels = np.empty(len(rows), dtype=np.int16)
+    for start in range(0, len(rows), CLUSTER_BATCH_SIZE):
+        labels[start:start + CLUSTER_BATCH_SIZE] = km.predict(emb_store.vectors(rows[start:start + CLUSTER_BATCH_SIZE]))
+    return labels
+
+# クラスタごとの特徴語を c-TF-IDF（クラスタ内頻度 × クラスタ間の希少度）で求める
+def cluster_keywords(texts: list, labels: np.ndarray, n_clusters: int) -> list:
+    from sklearn.feature_extraction.text import CountVectorizer
+    vectorizer = CountVectorizer(stop_words="english", max_features=CLUSTER_MAX_VOCAB, min_df=2 if len(texts) >= 50 else 1)
+    try:
+        X = vectorizer.fit_transform(texts)
+    except ValueError:
+        # 語彙が空（要約がすべて空など）
+        return [[] for _ in range(n_clusters)]
+    tf = np.vstack([np.asarray(X[labels == c].sum(axis=0)).ravel() for c in range(n_clusters)]).astype(np.float64)
+    tf_norm = tf / np.maximum(tf.sum(axis=1, keepdims=True), 1.0)
+    idf = np.log1p(tf.sum(axis=1).mean() / np.maximum(tf.sum(axis=0), 1.0))
+    scores = tf_norm * idf
+    vocab = vectorizer.get_feature_names_out()
+    keywords = []
+    for c in range(n_clusters):
+        top = np.argsort(scores[c])[::-1][:CLUSTER_KEYWORDS]
+        keywords.append([vocab[i] for i in top if tf[c, i] > 0])
+    return keywords
+
 # --------------------------------------------
 # 2. ページ設定・タイトル・説明
 # --------------------------------------------
@@ -172,10 +684,75 @@ if "publication_from" not in st.session_state:
     st.session_state.publication_from = ""
 if "search_ready" not in st.session_state:
     st.session_state.search_ready = False
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex  # 結果ストア用のセッションID
+
+# 検索結果・ランキング・解説は session_state ではなく共有ストアに保持する
+store = get_session_store()
+session_id = st.session_state.session_id
 
 # --------------------------------------------
 # 6. 関数定義: IPC コードを提案し、追加情報を促す質問をする
 # --------------------------------------------
+IPC_CODE_PATTERN = re.compile(r"[A-Z]\d{2}[A-Z]?\s*\d{1,2}/\d{1,2}")
+# セクション・クラス・サブクラス + メイングループ/サブグループ（例: H04W 72/0453）
+IPC_FULL_CODE_PATTERN = re.compile(r"[A-H]\d{2}[A-Z]\s*\d{1,4}\s*/\s*\d{2,6}")
+
+# 応答全文から IPC コードを抽出（空白除去・出現順で重複排除）
+def extract_ipc_codes(text: str) -> list:
+    unique_codes = []
+    for code in IPC_CODE_PATTERN.findall(text):
+        code_clean = code.replace(" ", "")
+        if code_clean not in unique_codes:
+            unique_codes.append(code_clean)
+    return unique_codes
+
+class IpcStreamExtractor:
+    """
+    ストリーミング中の応答から IPC コードを逐次抽出する。
+    バッファ末尾で終わるマッチは後続トークンで桁が伸びる可能性があるため確定を保留する。
+    on_code には確定したコードが1件ずつ渡され、応答の完了を待たずに検証・先行処理を始められる。
+    """
+
+    def __init__(self, on_code=None):
+        self.buffer = ""
+        self.codes = []
+        self.on_code = on_code
+        self._pos = 0
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        return self._scan(final=False)
+
+    def close(self) -> list:
+        return self._scan(final=True)
+
+    def _scan(self, final: bool) -> list:
+        new_codes = []
+        for m in IPC_CODE_PATTERN.finditer(self.buffer, self._pos):
+            if not final and m.end() >= len(self.buffer):
+                break
+            self._pos = m.end()
+            code_clean = m.group().replace(" ", "")
+            if code_clean not in self.codes:
+                self.codes.append(code_clean)
+                new_codes.append(code_clean)
+                if self.on_code:
+                    self.on_code(code_clean)
+        return new_codes
+
+# LLM 応答をトークン単位で chat_message に流し込み、全文を返す
+def stream_assistant_reply(lc_messages: list, on_token=None) -> str:
+    def _tokens():
+        for chunk in llm.stream(lc_messages):
+            if on_token:
+                on_token(chunk.content)
+            yield chunk.content
+
+    with st.chat_message("assistant"):
+        ai_content = st.write_stream(_tokens())
+    return ai_content.strip()
+
 def generate_ipc_candidates(user_input: str):
     # 会話履歴にユーザー発言を追加
     st.session_state.messages.append({"role": "user", "content": user_input})
@@ -193,22 +770,32 @@ def generate_ipc_candidates(user_input: str):
         HumanMessage(content=user_input)
     ]
 
-    # LLM コール
-    response = llm(lc_messages)
-    ai_content = response.content.strip()
+    # LLM コール（ストリーミング表示しながら IPC コードを逐次抽出）
+    codes_status = st.empty()
+    checked_codes = []
+    invalid_codes = []
 
-    # AI 応答を会話履歴に追加・表示
+    # 確定したコードから順に形式を検証する
+    def _on_code(code: str):
+        if IPC_FULL_CODE_PATTERN.fullmatch(code):
+            checked_codes.append(code)
+        else:
+            checked_codes.append(f"{code}（形式不正）")
+            invalid_codes.append(code)
+        codes_status.caption("検出した IPC コード: " + ", ".join(checked_codes))
+
+    extractor = IpcStreamExtractor(on_code=_on_code)
+    ai_content = stream_assistant_reply(lc_messages, on_token=extractor.feed)
+    extractor.close()
+    codes_status.empty()
+
+    # AI 応答を会話履歴に追加
     st.session_state.messages.append({"role": "assistant", "content": ai_content})
-    with st.chat_message("assistant"):
-        st.markdown(ai_content)
+    if invalid_codes:
+        st.warning("IPC コードの形式として不正な候補があります: " + ", ".join(invalid_codes))
 
-    # IPC コード部分を正規表現で抽出
-    codes = re.findall(r"[A-Z]\d{2}[A-Z]?\s*\d{1,2}/\d{1,2}", ai_content)
-    unique_codes = []
-    for code in codes:
-        code_clean = code.replace(" ", "")
-        if code_clean not in unique_codes:
-            unique_codes.append(code_clean)
+    # IPC コードは応答全文から確定させる（逐次抽出は検証・表示・先行処理用）
+    unique_codes = extract_ipc_codes(ai_content)
     st.session_state.ipc_candidates = unique_codes
     st.session_state.ipc_codes = unique_codes  # IPCコードを検索用にもセット
 
@@ -304,11 +891,8 @@ def suggest_technologies(user_input: str):
         SystemMessage(content=system_prompt),
         HumanMessage(content=user_input)
     ]
-    response = llm(lc_messages)
-    ai_content = response.content.strip()
+    ai_content = stream_assistant_reply(lc_messages)
     st.session_state.messages.append({"role": "assistant", "content": ai_content})
-    with st.chat_message("assistant"):
-        st.markdown(ai_content)
     # 追加質問を促す
     follow_up = "上記の中で特に調査したい内容や、さらに具体的な技術テーマがあればご記入ください。"
     st.session_state.messages.append({"role": "assistant", "content": follow_up})
@@ -318,19 +902,155 @@ def suggest_technologies(user_input: str):
     st.session_state.tech_suggested = True
 
 # --------------------------------------------
-# 9. 会話履歴を画面に表示
+# 9. 関数定義: 一括入力モード（1回の構造化出力で検索条件まで確定）
+# --------------------------------------------
+INTENT_MAX_RETRIES = 2
+SEARCH_INTENT_SCHEMA = {
+    "name": "search_intent",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "tech_topics": {"type": "array", "items": {"type": "string"}},
+            "ipc_codes": {"type": "array", "items": {"type": "string"}},
+            "countries": {"type": "array", "items": {"type": "string"}},
+            "assignees": {"type": "array", "items": {"type": "string"}},
+            "publication_from": {"type": "string"},
+        },
+        "required": ["tech_topics", "ipc_codes", "countries", "assignees", "publication_from"],
+        "additionalProperties": False,
+    },
+}
+
+# 構造化出力を検証・正規化する（不正な場合は ValueError）
+def validate_search_intent(parsed: dict) -> dict:
+    # 形式が不正な IPC コードは捨て、1つも残らない場合のみ再試行させる
+    ipc_codes = []
+    for code in parsed["ipc_codes"]:
+        if not IPC_FULL_CODE_PATTERN.fullmatch(code.strip()):
+            continue
+        code_clean = re.sub(r"\s+", "", code)
+        if code_clean not in ipc_codes:
+            ipc_codes.append(code_clean)
+    if not ipc_codes:
+        raise ValueError("有効なIPCコード（例: G06N 3/08, G06F 16/355）が1つも含まれていません。")
+    countries = [c.strip().upper() for c in parsed["countries"] if c.strip()]
+    for c in countries:
+        if not re.fullmatch(r"[A-Z]{2}", c):
+            raise ValueError(f"国コードは2文字で指定してください: {c}")
+    publication_from = parsed["publication_from"].strip()
+    if publication_from:
+        pd.to_datetime(publication_from, format="%Y-%m-%d")  # 不正な日付は ValueError
+    return {
+        "tech_topics": [t.strip() for t in parsed["tech_topics"] if t.strip()],
+        "ipc_codes": ipc_codes,
+        "countries": countries,
+        "assignees": [a.strip() for a in parsed["assignees"] if a.strip()],
+        "publication_from": publication_from,
+    }
+
+def extract_search_intent(user_input: str):
+    """
+    技術トピック・国・出願人・日付をまとめて入力された場合に、
+    技術サブトピック・IPC コード・検索パラメータを 1 回の LLM 呼び出しで生成する。
+    検証に失敗した場合はエラー内容を添えてローカルで再試行する。
+    """
+    st.session_state.messages.append({"role": "user", "content": user_input})
+    system_prompt = """
+    あなたは「特許調査アシスタント」です。ユーザー入力から以下を抽出・提案し、JSON で返してください。
+    ・tech_topics: 関連性の高い技術分野やサブトピック（2〜4 項、自然な日本語）
+    ・ipc_codes: 関連性の高い IPC コード 3〜5 個（例: "G06N 3/08"）
+    ・countries: 国コード (例: 日本→"JP", アメリカ→"US", 中国→"CN" 等)。指定がなければ空配列
+    ・assignees: 出願人名。指定がなければ空配列
+    ・publication_from: 公開日下限を "YYYY-MM-DD" 形式で (例: "2021年以降"→"2021-01-01")。指定がなければ空文字
+    """
+    structured_llm = llm.bind(
+        response_format={"type": "json_schema", "json_schema": SEARCH_INTENT_SCHEMA}
+    )
+    lc_messages = [
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=user_input)
+    ]
+    intent = None
+    for _ in range(INTENT_MAX_RETRIES + 1):
+        response = structured_llm.invoke(lc_messages)
+        try:
+            intent = validate_search_intent(json.loads(response.content))
+            break
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError, ValueError) as e:
+            # 検証エラーを伝えて再生成を依頼
+            lc_messages += [
+                response,
+                HumanMessage(content=f"出力が不正です（{e}）。スキーマに従って JSON を再出力してください。")
+            ]
+
+    if intent is None:
+        follow_up = (
+            "申し訳ありません。入力から検索条件をうまく抽出できませんでした。\n"
+            "一括入力モードをオフにして、対話形式で条件を指定してください。"
+        )
+        st.session_state.messages.append({"role": "assistant", "content": follow_up})
+        with st.chat_message("assistant"):
+            st.markdown(follow_up)
+        return
+
+    st.session_state.ipc_candidates = intent["ipc_codes"]
+    st.session_state.ipc_codes = intent["ipc_codes"]
+    st.session_state.countries = intent["countries"]
+    st.session_state.assignees = intent["assignees"]
+    st.session_state.publication_from = intent["publication_from"]
+
+    result = {
+        "ipc_codes": intent["ipc_codes"],
+        "countries": intent["countries"],
+        "assignees": intent["assignees"],
+        "publication_from": intent["publication_from"]
+    }
+    json_result = json.dumps(result, ensure_ascii=False, indent=2)
+    topics = "\n".join(f"{i}. {t}" for i, t in enumerate(intent["tech_topics"], 1))
+    final_message = (
+        f"関連する技術トピック:\n{topics}\n\n"
+        "以下が最終的な検索条件です。\n"
+        f"```json\n{json_result}"
+    )
+    st.session_state.messages.append({"role": "assistant", "content": final_message})
+    with st.chat_message("assistant"):
+        st.markdown(final_message)
+    # 対話フローのフラグを確定済みの状態にそろえる
+    st.session_state.expect_tech_suggestion = False
+    st.session_state.tech_suggested = True
+    st.session_state.expect_search_params = False
+    st.session_state.search_ready = True
+
+# --------------------------------------------
+# 10. 会話履歴を画面に表示
 # --------------------------------------------
-for msg in st.session_state.messages:
+# 履歴が長い場合は直近の CHAT_HISTORY_WINDOW 件のみ描画する
+CHAT_HISTORY_WINDOW = 20
+history = st.session_state.messages
+if len(history) > CHAT_HISTORY_WINDOW and not st.checkbox(
+    f"過去のメッセージをすべて表示（{len(history) - CHAT_HISTORY_WINDOW}件を省略中）", key="show_full_history"
+):
+    history = history[-CHAT_HISTORY_WINDOW:]
+for msg in history:
     with st.chat_message(msg["role"]):
         st.markdown(msg["content"])
 
 # --------------------------------------------
-# 10. チャット入力フォーム
+# 11. チャット入力フォーム
 # --------------------------------------------
+one_shot_mode = st.toggle(
+    "一括入力モード（技術トピック・国・出願人・公開日をまとめて入力）",
+    key="one_shot_mode",
+    help="例: 逆浸透膜の機械学習, JP, Toray, 2021年以降"
+)
 user_input = st.chat_input("入力してください…")
 
 if user_input:
-    if st.session_state.expect_tech_suggestion:
+    if one_shot_mode:
+        # 一括入力ステップ（LLM 呼び出し 1 回）
+        extract_search_intent(user_input)
+    elif st.session_state.expect_tech_suggestion:
         # 技術深掘りステップ
         suggest_technologies(user_input)
     elif not st.session_state.ipc_candidates:
@@ -348,6 +1068,207 @@ if user_input:
         suggest_technologies(user_input)
 
 # --- Streamlit UIの続き ---
+# 結果エリア・ランキング・解説はそれぞれ fragment として独立に再実行する
+RESULTS_PAGE_SIZE = 50
+
+# 大きな結果表はページ単位でのみ描画する
+def render_paginated_df(df: pd.DataFrame, key: str):
+    n_pages = max(1, -(-len(df) // RESULTS_PAGE_SIZE))
+    page = 1
+    if n_pages > 1:
+        # 結果が差し替わってページ数が減った場合は先頭ページに戻す
+        if st.session_state.get(f"{key}_page", 1) > n_pages:
+            st.session_state[f"{key}_page"] = 1
+        page = st.number_input(f"ページ (全{n_pages}ページ)", min_value=1, max_value=n_pages, value=1, step=1, key=f"{key}_page")
+    start = (page - 1) * RESULTS_PAGE_SIZE
+    st.dataframe(df.iloc[start:start + RESULTS_PAGE_SIZE])
+    st.caption(f"{len(df)}件中 {start + 1}〜{min(start + RESULTS_PAGE_SIZE, len(df))}件を表示")
+
+@st.fragment
+def render_results_panel(params: dict):
+    st.markdown("### 特許データ検索・ベクトル化・類似度ランキング")
+    if st.button("特許検索・類似度ランキング実行"):
+        try:
+            with st.spinner("BigQueryから特許データ抽出中..."):
+                df = search_patents_by_params(params)
+        except Exception as e:
+            st.error(f"特許データの検索中にエラーが発生しました: {e}")
+            df = None
+        if df is not None and df.empty:
+            st.warning("該当する特許が見つかりませんでした。")
+        elif df is not None:
+            store.put(session_id, "search_df", compact_dataframe(df))  # ← ストアに保存
+            # 旧ランキングは新しい検索結果の行番号と対応しないため破棄
+            store.delete(session_id, "ranking")
+            store.delete(session_id, "explanations")
+            store.delete(session_id, "export_csv")
+            store.delete(session_id, "clusters")
+            # 取得完了メッセージは検索直後の1回だけ表示する
+            st.session_state["search_done_count"] = len(df)
+            # ランキング・解説パネルも新しい結果で描画し直す
+            st.rerun()
+    df = store.get(session_id, "search_df")
+    if df is not None and not df.empty:
+        search_done_count = st.session_state.pop("search_done_count", None)
+        if search_done_count is not None:
+            st.success(f"{search_done_count}件の特許を取得しました。ベクトル化・ランキングを実行します。")
+        st.markdown("#### 取得特許一覧（検索条件に合致したもの）")
+        render_paginated_df(df, key="search_df")
+
+@st.fragment
+def render_ranking_panel():
+    df = store.get(session_id, "search_df")
+    if df is None or df.empty:
+        return
+    st.markdown("#### 検索意図や追加クエリ（ベクトル類似度計算用）")
+    st.info("この欄には『知りたい内容』『重視したい観点』『追加キーワード』などを自然文で入力してください。例：AIによる水質異常検知の最新技術 など")
+    query_text = st.text_input("検索意図や追加クエリ（ベクトル類似度計算用）", key="query_text")
+    if st.button("類似度ランキング実行", key="rank_button") and query_text:
+        try:
+            texts = df["abstract"].astype("string").fillna("").tolist()
+            if not any(texts):
+                st.warning("特許要約（abstract）が空のため、類似度ランキングを実行できません。")
+            else:
+                patent_ids = df["publication_number"].astype(str).tolist()
+                idx, sims = rank_by_similarity(query_text, texts, openai_api_key, patent_ids=patent_ids)
+                store.put(session_id, "ranking", compact_ranking(idx, sims))  # ランキングは index+score のみ保存
+                store.delete(session_id, "explanations")  # 解説リセット
+                # 解説パネルを新しいランキングで描画し直す
+                st.rerun()
+        except Exception as e:
+            st.error(f"類似度ランキング処理中にエラーが発生しました: {e}")
+    ranking = store.get(session_id, "ranking")
+    if ranking is None:
+        return
+    df_ranked = build_ranked_df(df, ranking)
+    render_paginated_df(df_ranked, key="df_ranked")
+    # CSV はランキングごとに一度だけ、要求されたときに生成する
+    export = store.get(session_id, "export_csv")
+    if export is None or export["token"] != ranking["token"]:
+        if st.button("CSVエクスポートを準備", key="csv_prepare"):
+            export = {"token": ranking["token"], "csv": df_ranked.to_csv(index=False).encode("utf-8-sig")}
+            store.put(session_id, "export_csv", export)
+    if export is not None and export["token"] == ranking["token"]:
+        st.download_button("CSVダウンロード", export["csv"], "results.csv", "text/csv", key="csv_download")
+
+@st.fragment
+def render_explanation_panel():
+    # --- ランキング結果があればN件解説UIを常に表示 ---
+    df = store.get(session_id, "search_df")
+    ranking = store.get(session_id, "ranking")
+    if df is None or df.empty or ranking is None:
+        return
+    st.markdown("#### 上位N件の特許を選択し、日本語で解説")
+    n_max = min(10, len(df))
+    if "topn" not in st.session_state:
+        st.session_state["topn"] = min(3, n_max)
+    n = st.number_input("解説したい上位件数 (N)", min_value=1, max_value=n_max, value=st.session_state["topn"], step=1, key="topn")
+    if st.button("選択したN件を日本語で解説", key="explain_button"):
+        topN_df = build_ranked_df(df, {"idx": ranking["idx"][:n], "scores": ranking["scores"]})
+        explanations = []
+        import openai
+        client = openai.OpenAI(api_key=openai_api_key)
+        for i, row in topN_df.iterrows():
+            jp_prompt = (
+                "以下は特許の要約です。専門用語も分かりやすく、200字程度で日本語で解説してください。\n"
+                "---\n"
+                f"{row['abstract']}"
+            )
+            try:
+                response = client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[{"role": "system", "content": jp_prompt}]
+                )
+                jp_summary = response.choices[0].message.content.strip()
+            except Exception as e:
+                jp_summary = f"要約生成エラー: {e}"
+            explanations.append({"title": row['title'], "summary": jp_summary})
+        store.put(session_id, "explanations", explanations)
+    # --- 解説結果があれば表示 ---
+    explanations = store.get(session_id, "explanations")
+    if explanations:
+        for i, ex in enumerate(explanations, 1):
+            st.markdown(f"**{i}件目: {ex['title']}**")
+            st.info(ex["summary"])
+
+# クラスタ名を LLM で生成（1クラスタにつき1回まで）
+def label_cluster_with_llm(keywords: list, titles: list) -> str:
+    prompt = (
+        "以下は特許群の特徴語と代表的な特許タイトルです。"
+        "この特許群の技術テーマを表す日本語の短いラベル（20字以内）だけを返してください。\n"
+        f"特徴語: {', '.join(keywords)}\n"
+        "タイトル:\n" + "\n".join(f"- {t}" for t in titles)
+    )
+    response = llm.invoke([SystemMessage(content=prompt)])
+    return response.content.strip()
+
+@st.fragment
+def render_cluster_panel():
+    df = store.get(session_id, "search_df")
+    if df is None or df.empty:
+        return
+    st.markdown("#### トピッククラスタ（ランドスケープ）")
+    max_clusters = min(50, len(df))
+    if max_clusters < 2:
+        st.info("クラスタリングには2件以上の特許が必要です。")
+        return
+    n_clusters = st.slider("クラスタ数", min_value=2, max_value=max_clusters, value=min(8, max_clusters), key="n_clusters")
+    if st.button("クラスタリング実行", key="cluster_button"):
+        try:
+            texts = (df["title"].astype("string").fillna("") + ". " + df["abstract"].astype("string").fillna("")).tolist()
+            patent_ids = df["publication_number"].astype(str).tolist()
+            with st.spinner("ベクトル化・クラスタリング中..."):
+                rows = embed_with_store(df["abstract"].astype("string").fillna("").tolist(), patent_ids, openai_api_key)
+                # 要約が空でベクトルのない特許はクラスタリング対象外（ラベル -1）
+                embedded = np.flatnonzero(rows >= 0)
+                if len(embedded) < n_clusters:
+                    st.warning("要約のある特許がクラスタ数より少ないため、クラスタリングできません。")
+                else:
+                    labels = np.full(len(rows), -1, dtype=np.int16)
+                    labels[embedded] = cluster_embeddings(rows[embedded], n_clusters)
+                    keywords = cluster_keywords(texts, labels, n_clusters)
+                    store.put(session_id, "clusters", {"labels": labels, "keywords": keywords, "llm_labels": {}})
+        except Exception as e:
+            st.error(f"クラスタリング処理中にエラーが発生しました: {e}")
+    clusters = store.get(session_id, "clusters")
+    if clusters is None:
+        return
+    labels = clusters["labels"]
+    ranking = store.get(session_id, "ranking")
+    # クラスタ内はランキング済みなら類似度順、未実行なら検索結果順
+    order = ranking["idx"] if ranking is not None else np.arange(len(df))
+    if st.button("LLMでクラスタ名を生成", key="cluster_label_button"):
+        with st.spinner("クラスタ名を生成中..."):
+            for c, kws in enumerate(clusters["keywords"]):
+                if c in clusters["llm_labels"] or not (labels == c).any():
+                    continue
+                members = order[labels[order] == c][:5]
+                titles = df["title"].astype("string").fillna("").iloc[members].tolist()
+                try:
+                    clusters["llm_labels"][c] = label_cluster_with_llm(kws, titles)
+                except Exception as e:
+                    clusters["llm_labels"][c] = f"ラベル生成エラー: {e}"
+        store.put(session_id, "clusters", clusters)
+    n_unclustered = int((labels < 0).sum())
+    if n_unclustered:
+        st.caption(f"要約が空の{n_unclustered}件はクラスタリングの対象外です。")
+    sizes = np.bincount(labels[labels >= 0], minlength=len(clusters["keywords"]))
+    summary = pd.DataFrame({
+        "cluster": np.arange(1, len(sizes) + 1),
+        "件数": sizes,
+        "ラベル": [clusters["llm_labels"].get(c, "") for c in range(len(sizes))],
+        "特徴語": [", ".join(kws) for kws in clusters["keywords"]],
+    }).sort_values("件数", ascending=False)
+    summary = summary[summary["件数"] > 0]
+    st.dataframe(summary, hide_index=True)
+    selected = st.selectbox("表示するクラスタ", summary["cluster"].tolist(), key="cluster_select")
+    members = order[labels[order] == selected - 1]
+    if ranking is not None:
+        cluster_df = build_ranked_df(df, {"idx": members, "scores": ranking["scores"]})
+    else:
+        cluster_df = df.iloc[members]
+    render_paginated_df(cluster_df, key="cluster_members")
+
 # 検索パラメータJSONが生成されたら検索・ベクトル化・ランキング・表示
 if st.session_state.get("search_ready", False):
     params = {
@@ -356,72 +1277,12 @@ if st.session_state.get("search_ready", False):
         "assignees": st.session_state.assignees,
         "publication_from": st.session_state.publication_from
     }
-    st.markdown("### 特許データ検索・ベクトル化・類似度ランキング")
-    if st.button("特許検索・類似度ランキング実行"):
-        with st.spinner("BigQueryから特許データ抽出中..."):
-            df = search_patents_by_params(params)
-        if df.empty:
-            st.warning("該当する特許が見つかりませんでした。")
-        else:
-            st.session_state["search_df"] = df  # ← セッションに保存
-            st.success(f"{len(df)}件の特許を取得しました。ベクトル化・ランキングを実行します。")
-            st.markdown("#### 取得特許一覧（検索条件に合致したもの）")
-            st.dataframe(df)
-    # --- ここからは常にセッションのdfを参照 ---
-    df = st.session_state.get("search_df")
-    if df is not None and not df.empty:
-        st.markdown("#### 検索意図や追加クエリ（ベクトル類似度計算用）")
-        st.info("この欄には『知りたい内容』『重視したい観点』『追加キーワード』などを自然文で入力してください。例：AIによる水質異常検知の最新技術 など")
-        query_text = st.text_input("検索意図や追加クエリ（ベクトル類似度計算用）", key="query_text")
-        if st.button("類似度ランキング実行", key="rank_button") and query_text:
-            try:
-                texts = df["abstract"].fillna("").tolist()
-                if not any(texts):
-                    st.warning("特許要約（abstract）が空のため、類似度ランキングを実行できません。")
-                else:
-                    idx, sims = rank_by_similarity(query_text, texts, openai_api_key)
-                    df_ranked = df.iloc[idx].copy()
-                    df_ranked["similarity"] = sims[idx]
-                    st.session_state["df_ranked"] = df_ranked  # ランキング結果をセッションに保存
-                    st.session_state["explanations"] = None  # 解説リセット
-                    st.dataframe(df_ranked)
-                    csv = df_ranked.to_csv(index=False).encode("utf-8-sig")
-                    st.download_button("CSVダウンロード", csv, "results.csv", "text/csv", key="csv_download")
-            except Exception as e:
-                st.error(f"類似度ランキング処理中にエラーが発生しました: {e}")
-
-        # --- ランキング結果があればN件解説UIを常に表示 ---
-        df_ranked = st.session_state.get("df_ranked")
-        if df_ranked is not None and not df_ranked.empty:
-            st.markdown("#### 上位N件の特許を選択し、日本語で解説")
-            n_max = min(10, len(df_ranked))
-            if "topn" not in st.session_state:
-                st.session_state["topn"] = min(3, n_max)
-            n = st.number_input("解説したい上位件数 (N)", min_value=1, max_value=n_max, value=st.session_state["topn"], step=1, key="topn")
-            if st.button("選択したN件を日本語で解説", key="explain_button"):
-                topN_df = df_ranked.head(n)
-                explanations = []
-                import openai
-                client = openai.OpenAI(api_key=openai_api_key)
-                for i, row in topN_df.iterrows():
-                    jp_prompt = (
-                        "以下は特許の要約です。専門用語も分かりやすく、200字程度で日本語で解説してください。\n"
-                        "---\n"
-                        f"{row['abstract']}"
-                    )
-                    try:
-                        response = client.chat.completions.create(
-                            model="gpt-4o",
-                            messages=[{"role": "system", "content": jp_prompt}]
-                        )
-                        jp_summary = response.choices[0].message.content.strip()
-                    except Exception as e:
-                        jp_summary = f"要約生成エラー: {e}"
-                    explanations.append({"title": row['title'], "summary": jp_summary})
-                st.session_state["explanations"] = explanations
-            # --- 解説結果があれば表示 ---
-            explanations = st.session_state.get("explanations")
-            if explanations:
-                for i, ex in enumerate(explanations, 1):
-                    st.markdown(f"**{i}件目: {ex['title']}**")
-                    st.info(ex["summary"])
+    render_results_panel(params)
+    if store.get(session_id, "search_df") is not None:
+        # 類似度ランキングとトピッククラスタを並べて表示
+        tab_ranking, tab_clusters = st.tabs(["類似度ランキング", "トピッククラスタ"])
+        with tab_ranking:
+            render_ranking_panel()
+            render_explanation_panel()
+        with tab_clusters:
+            render_cluster_panel()